@@ -0,0 +1,35 @@
+# examples/gemini_chat.py
+"""
+Conversation helpers shared by the example agents.
+
+The history is a list of {role, parts} turns passed to Gemini as `contents`.
+The system prompt travels separately as system_instruction, so it is never
+replayed inside the history.
+"""
+import os
+from typing import Awaitable, Callable, Optional
+
+from llm_cache import cached_generate
+
+# Unset by default: the model's own sampling temperature applies
+LLM_TEMPERATURE: Optional[float] = float(os.environ["LLM_TEMPERATURE"]) if os.getenv("LLM_TEMPERATURE") else None
+
+def gen_config(system_prompt: str) -> dict:
+    """Per-call generation config: the system prompt as system_instruction, plus LLM_TEMPERATURE if set."""
+    config = {"system_instruction": system_prompt}
+    if LLM_TEMPERATURE is not None:
+        config["temperature"] = LLM_TEMPERATURE
+    return config
+
+def add_turn(history: list, role: str, text: str) -> None:
+    """Append a {role, parts} turn, folding consecutive same-role messages into one content."""
+    if history and history[-1]["role"] == role:
+        history[-1]["parts"].append({"text": text})
+    else:
+        history.append({"role": role, "parts": [{"text": text}]})
+
+async def generate(history: list, call: Callable[[list], Awaitable[Optional[str]]]) -> Optional[str]:
+    """`call(history)`, behind the response cache only when LLM_TEMPERATURE=0 was set explicitly."""
+    if LLM_TEMPERATURE != 0:  # unset or sampling: replies aren't reproducible, so never cached
+        return await call(history)
+    return await cached_generate(history, call, temperature=0.0)
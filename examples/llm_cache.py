@@ -0,0 +1,46 @@
+# examples/llm_cache.py
+"""
+Response cache shared by the example agents.
+
+Exact match on sha256(prompt), LRU-bounded. Structured `contents` lists are
+keyed by their canonical JSON. Only deterministic generations
+(temperature == 0) are cached.
+"""
+import os, hashlib, json
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Union
+
+Prompt = Union[str, list]
+
+CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "512"))
+if CACHE_SIZE < 1:
+    raise ValueError(f"LLM_CACHE_SIZE must be >= 1, got {CACHE_SIZE}")
+
+_exact: "OrderedDict[str, str]" = OrderedDict()
+
+def _canonical(prompt: Prompt) -> str:
+    return prompt if isinstance(prompt, str) else json.dumps(prompt, ensure_ascii=False, sort_keys=True)
+
+async def cached_generate(
+    prompt: Prompt,
+    generate: Callable[[Any], Awaitable[Optional[str]]],
+    temperature: float = 0.0,
+) -> Optional[str]:
+    """
+    Return a cached completion for `prompt`, or call `generate(prompt)` and cache it.
+    Failed generations (None/"") are not cached.
+    """
+    if temperature != 0:
+        return await generate(prompt)
+
+    key = hashlib.sha256(_canonical(prompt).encode("utf-8")).hexdigest()
+    if key in _exact:
+        _exact.move_to_end(key)
+        return _exact[key]
+
+    text = await generate(prompt)
+    if text:
+        _exact[key] = text
+        if len(_exact) > CACHE_SIZE:
+            _exact.popitem(last=False)
+    return text
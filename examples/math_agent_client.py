@@ -1,4 +1,4 @@
-import os, asyncio, re, json, time
+import os, asyncio, re, json
 from dotenv import load_dotenv
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
@@ -16,6 +16,9 @@ LLM_MODEL = os.getenv("LLM_MODEL", "gemini-1.5-flash")
 LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
 client = genai.Client(api_key=GEMINI_API_KEY)
 
+from gemini_chat import add_turn, gen_config, generate
+from rate_limit import throttle
+
 SYSTEM_PROMPT = (
     "You are a mathematical reasoning agent that solves problems step by step.\n"
     "TOOLS:\n"
@@ -30,15 +33,24 @@ SYSTEM_PROMPT = (
     "   FINAL_ANSWER: [answer]\n"
     "3) If your last output violated the format, immediately output a corrected single line now.\n"
     "4) First show_reasoning (JSON array), then calculate, then verify each step, then final answer.\n"
+    "5) Inside show_reasoning steps, wrap each arithmetic sub-expression in brackets, e.g. \"Add [23 + 7]\".\n"
 )
 
-ALLOWED_EXPR = re.compile(r"^[0-9.\s+\-*/%()]+$")
+GEN_CONFIG = gen_config(SYSTEM_PROMPT)
+
+ALLOWED_EXPR = re.compile(r"[0-9.\s+\-*/%()]+")  # match with .fullmatch
+FINAL_ANSWER_RE = re.compile(r"FINAL_ANSWER:\s*\[(-?\d+(?:\.\d+)?)\]")
+STEP_EXPR_RE = re.compile(r"\[([^\[\]]+)\]")     # bracketed sub-expressions inside reasoning steps
+CALC_CONCURRENCY = 8
 
 def first_line(s: str) -> str:
     return (s or "").splitlines()[0].strip()
 
 def strip_code_fences(s: str) -> str:
-    return re.sub(r"```.*?```", "", s or "", flags=re.S)
+    s = s or ""
+    if "```" not in s:
+        return s
+    return "".join(s.split("```")[::2])  # keep outside-fence segments
 
 def clean_arg(s: str) -> str:
     s = strip_code_fences(s).strip()
@@ -48,7 +60,7 @@ def clean_arg(s: str) -> str:
 
 def sanitize_expr(expr: str) -> str:
     expr = clean_arg(expr)
-    if not ALLOWED_EXPR.match(expr):
+    if not ALLOWED_EXPR.fullmatch(expr):
         raise ValueError(f"Unsafe or invalid expression: {expr!r}")
     return expr
 
@@ -59,101 +71,150 @@ def parse_steps(steps_txt: str):
         raise ValueError("steps must be a JSON array of strings.")
     return steps
 
-def llm_call_sync(prompt: str):
-    # Backoff on 429/RESOURCE_EXHAUSTED
-    for attempt in range(LLM_MAX_RETRIES):
+async def llm_call(contents: list, timeout: float = 90):
+    # Backoff on 429/RESOURCE_EXHAUSTED without blocking the event loop
+    for _ in range(LLM_MAX_RETRIES):
         try:
-            resp = client.models.generate_content(model=LLM_MODEL, contents=prompt)
+            async with throttle.slot():
+                resp = await asyncio.wait_for(
+                    asyncio.to_thread(
+                        client.models.generate_content,
+                        model=LLM_MODEL, contents=contents, config=GEN_CONFIG,
+                    ),
+                    timeout=timeout,
+                )
+            throttle.record(denied=False)
             text = getattr(resp, "text", None)
             return text.strip() if text else None
         except Exception as e:
             msg = str(e)
             if "429" in msg or "RESOURCE_EXHAUSTED" in msg or "RetryInfo" in msg:
-                time.sleep(10 * (attempt + 1))  # 10s, 20s, 30s, ...
+                throttle.record(denied=True, error=e)  # next slot() waits by congestion / Retry-After
                 continue
             console.print(Panel(f"LLM Error: {e}", border_style="red"))
             return None
     return None
 
-async def generate_with_timeout(prompt, timeout=90):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, lambda: llm_call_sync(prompt))
+def step_exprs(steps: list) -> list:
+    # Unique, arithmetic-only [bracketed] expressions, in order of appearance
+    found = (m.group(1).strip() for step in steps for m in STEP_EXPR_RE.finditer(step))
+    return list(dict.fromkeys(e for e in found if ALLOWED_EXPR.fullmatch(e)))
 
-async def main():
-    problem = os.getenv("MATH_PROBLEM", "(23 + 7) * (15 - 8)")
-    console.print(Panel(f"Problem: {problem}", border_style="cyan"))
-    server_params = StdioServerParameters(command="python", args=["tools/cot_tools.py"])
+async def calculate_all(session, exprs: list) -> dict:
+    # Overlap the MCP round-trips for independent expressions; bounded by CALC_CONCURRENCY
+    sem = asyncio.Semaphore(CALC_CONCURRENCY)
 
-    async with stdio_client(server_params) as (read, write):
-        async with ClientSession(read, write) as session:
-            await session.initialize()
-            prompt = f"{SYSTEM_PROMPT}\n\nSolve this problem step by step: {problem}"
-            history = []
-
-            while True:
-                result = await generate_with_timeout(prompt)
-                if not result:
-                    break
-                result = first_line(result)
-                console.print(f"[yellow]Assistant:[/yellow] {result}")
-
-                if result.startswith("FUNCTION_CALL:"):
-                    _, info = result.split(":", 1)
-                    parts = [p.strip() for p in info.split("|")]
-                    fn = parts[0]
-
-                    if fn == "show_reasoning":
-                        try:
-                            steps = parse_steps(parts[1])
-                        except Exception as e:
-                            prompt += f"\nUser: steps must be JSON array of strings ({e}). Return: FUNCTION_CALL: show_reasoning|[\"step1\",\"step2\"]"
-                            continue
-                        await session.call_tool("show_reasoning", arguments={"steps": steps})
-                        prompt += "\nUser: Next step?"
-
-                    elif fn == "calculate":
-                        try:
-                            expr = sanitize_expr(parts[1])
-                        except Exception as e:
-                            prompt += f"\nUser: Invalid expression ({e}). Return: FUNCTION_CALL: calculate|<digits and + - * / % ( ) . only>"
-                            continue
-                        calc = await session.call_tool("calculate", arguments={"expression": expr})
-                        if calc.content:
-                            val_txt = (calc.content[0].text or "").strip()
-                            if val_txt.startswith("Error:"):
-                                prompt += f"\nUser: Tool error ({val_txt}). Retry with clean arithmetic."
-                                continue
-                            try:
-                                val = float(val_txt)
-                            except Exception:
-                                prompt += f"\nUser: Non-numeric output ({val_txt}). Retry calculate."
-                                continue
-                            prompt += f"\nUser: Result is {val}. Let's verify this step."
-                            history.append((expr, val))
-
-                    elif fn == "verify":
-                        try:
-                            expr = sanitize_expr(parts[1])
-                            expected = float(clean_arg(parts[2]))
-                        except Exception:
-                            prompt += "\nUser: verify expected must be numeric and expr arithmetic-only. Retry verify."
-                            continue
-                        await session.call_tool("verify", arguments={"expression": expr, "expected": expected})
-                        prompt += "\nUser: Verified. Next step?"
-
-                elif result.startswith("FINAL_ANSWER:"):
+    async def one(expr):
+        async with sem:
+            return await session.call_tool("calculate", arguments={"expression": expr})
+
+    values = {}
+    for expr, res in zip(exprs, await asyncio.gather(*(one(e) for e in exprs))):
+        try:
+            values[expr] = float((res.content[0].text or "").strip())
+        except Exception:
+            pass  # tool error / non-numeric: leave it for the model to calculate
+    return values
+
+async def solve(session: ClientSession, problem: str):
+    console.print(Panel(f"Problem: {problem}", border_style="cyan"))
+    history = []
+    add_turn(history, "user", f"Solve this problem step by step: {problem}")
+    computed = []
+    verified: set[str] = set()  # whitespace-normalized expressions already verified
+
+    while True:
+        result = await generate(history, llm_call)
+        if not result:
+            break
+        result = first_line(result)
+        console.print(f"[yellow]Assistant:[/yellow] {result}")
+        add_turn(history, "model", result)
+
+        if result.startswith("FUNCTION_CALL:"):
+            _, info = result.split(":", 1)
+            parts = [p.strip() for p in info.split("|")]
+            fn = parts[0]
+
+            if fn == "show_reasoning":
+                try:
+                    steps = parse_steps(parts[1])
+                except Exception as e:
+                    add_turn(history, "user", f"steps must be JSON array of strings ({e}). Return: FUNCTION_CALL: show_reasoning|[\"step1\",\"step2\"]")
+                    continue
+                await session.call_tool("show_reasoning", arguments={"steps": steps})
+                values = await calculate_all(session, step_exprs(steps))
+                if values:
+                    computed.extend(values.items())
+                    add_turn(history, "user", f"computed: {json.dumps(values)}. Verify the final result, then give FINAL_ANSWER.")
+                else:
+                    add_turn(history, "user", "Next step?")
+
+            elif fn == "calculate":
+                try:
+                    expr = sanitize_expr(parts[1])
+                except Exception as e:
+                    add_turn(history, "user", f"Invalid expression ({e}). Return: FUNCTION_CALL: calculate|<digits and + - * / % ( ) . only>")
+                    continue
+                calc = await session.call_tool("calculate", arguments={"expression": expr})
+                if calc.content:
+                    val_txt = (calc.content[0].text or "").strip()
+                    if val_txt.startswith("Error:"):
+                        add_turn(history, "user", f"Tool error ({val_txt}). Retry with clean arithmetic.")
+                        continue
                     try:
-                        final = float(result.split("[", 1)[1].split("]", 1)[0])
+                        val = float(val_txt)
                     except Exception:
-                        prompt += "\nUser: FINAL_ANSWER must be like: FINAL_ANSWER: [123.45]"
+                        add_turn(history, "user", f"Non-numeric output ({val_txt}). Retry calculate.")
                         continue
-                    if history:
-                        await session.call_tool("verify", arguments={"expression": problem, "expected": final})
-                    break
+                    add_turn(history, "user", f"Result is {val}. Let's verify this step.")
+                    computed.append((expr, val))
+
+            elif fn == "verify":
+                try:
+                    expr = sanitize_expr(parts[1])
+                    expected = float(clean_arg(parts[2]))
+                except Exception:
+                    add_turn(history, "user", "verify expected must be numeric and expr arithmetic-only. Retry verify.")
+                    continue
+                key = "".join(expr.split())
+                if key in verified:
+                    add_turn(history, "user", "Already verified. Next step?")
+                    continue
+                verified.add(key)
+                await session.call_tool("verify", arguments={"expression": expr, "expected": expected})
+                add_turn(history, "user", "Verified. Next step?")
+
+        elif result.startswith("FINAL_ANSWER:"):
+            m = FINAL_ANSWER_RE.match(result)
+            try:
+                final = float(m.group(1) if m else result.split("[", 1)[1].split("]", 1)[0])
+            except Exception:
+                add_turn(history, "user", "FINAL_ANSWER must be like: FINAL_ANSWER: [123.45]")
+                continue
+            # the "computed" hint usually has the model verify `problem` itself; don't repeat it here
+            if computed and "".join(problem.split()) not in verified:
+                await session.call_tool("verify", arguments={"expression": problem, "expected": final})
+            break
 
-                prompt += f"\nAssistant: {result}"
+        # Keep conversation flowing
+        if history[-1]["role"] == "model":
+            add_turn(history, "user", "Next step?")
 
     console.print(Panel("Calculation completed!", border_style="green"))
 
+async def main_batch(problems: list):
+    # One MCP subprocess + handshake amortized across all problems
+    server_params = StdioServerParameters(command="python", args=["tools/cot_tools.py"])
+    async with stdio_client(server_params) as (read, write):
+        async with ClientSession(read, write) as session:
+            await session.initialize()
+            for problem in problems:
+                await solve(session, problem)
+
+async def main():
+    await main_batch([os.getenv("MATH_PROBLEM", "(23 + 7) * (15 - 8)")])
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    # python examples/math_agent_client.py "1 + 2" "(3 * 4) - 5"  → batch over one session
+    asyncio.run(main_batch(sys.argv[1:]) if len(sys.argv) > 1 else main())
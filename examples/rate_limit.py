@@ -0,0 +1,63 @@
+# examples/rate_limit.py
+"""
+Congestion-aware client-side throttle (AATB-style) for Gemini calls.
+
+Instead of backing off by attempt count, every send waits in proportion to the
+recently observed 429 rate, so all callers in the process slow down together
+while the quota is contended and stop waiting once it clears.
+"""
+import asyncio, random, re, time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+RETRY_DELAY_RE = re.compile(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s")
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Server-provided RetryInfo delay (seconds) carried by a 429 error, if any."""
+    hinted = getattr(e, "retry_delay", None)
+    if isinstance(hinted, (int, float)):
+        return float(hinted)
+    m = RETRY_DELAY_RE.search(str(e))
+    return float(m.group(1)) if m else None
+
+class AATB:
+    """
+    Adaptive throttle shared by every LLM call in the process.
+
+    ewma_429 is an exponentially weighted average of recent denials (1 = 429, 0 = ok).
+    Each send waits base * k * ewma_429, scaled by the number of requests already
+    in flight and capped at `cap`; with no recent 429s the wait is zero. A server
+    Retry-After hint sets a floor that no send may start before.
+    """
+
+    def __init__(self, base: float = 1.0, k: float = 10.0, alpha: float = 0.3,
+                 cap: float = 30.0, jitter: float = 0.5):
+        self.base, self.k, self.alpha, self.cap, self.jitter = base, k, alpha, cap, jitter
+        self.ewma_429 = 0.0
+        self.inflight = 0
+        self._not_before = 0.0
+
+    def delay(self) -> float:
+        wait = self.base * self.k * self.ewma_429 * (1 + self.inflight)
+        if wait:
+            wait = min(self.cap, wait) * (1 + random.uniform(0, self.jitter))
+        return max(wait, self._not_before - time.monotonic())
+
+    def record(self, denied: bool, error: Optional[Exception] = None) -> None:
+        self.ewma_429 += self.alpha * ((1.0 if denied else 0.0) - self.ewma_429)
+        hint = retry_after(error) if denied and error is not None else None
+        if hint:
+            self._not_before = max(self._not_before, time.monotonic() + hint)
+
+    @asynccontextmanager
+    async def slot(self):
+        wait = self.delay()
+        self.inflight += 1
+        try:
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield
+        finally:
+            self.inflight -= 1
+
+throttle = AATB()
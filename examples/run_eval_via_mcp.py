@@ -1,4 +1,5 @@
-import os, asyncio, json, argparse
+import os, asyncio, argparse
+import orjson
 from dotenv import load_dotenv
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
@@ -10,12 +11,29 @@ from rich.console import Console
 console = Console(file=sys.stderr)
 load_dotenv()
 
+async def evaluate_file(session: ClientSession, path: str, student_text: str):
+    console.print(Panel.fit(f"Calling evaluate_prompt(...) via MCP for {path}", border_style="cyan"))
+    res = await session.call_tool("evaluate_prompt", arguments={"student_prompt": student_text})
+
+    text = res.content[0].text if res and res.content else "{}"
+    try:
+        data = orjson.loads(text)
+        out = Path("outputs") / (Path(path).stem + ".json")
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        console.print(Panel.fit(f"Saved JSON → {out}", border_style="green"))
+        console.print_json(data=data)
+    except orjson.JSONDecodeError:
+        out = Path("outputs") / (Path(path).stem + ".txt")
+        out.parent.mkdir(parents=True, exist_ok=True)
+        out.write_text(text, encoding="utf-8")
+        console.print(Panel.fit(f"Saved raw text → {out}", border_style="yellow"))
+
 async def main():
-    ap = argparse.ArgumentParser(description="Evaluate a student prompt via MCP tool")
-    ap.add_argument("-f","--file",required=True, help="Path to a text file with the student prompt")
+    ap = argparse.ArgumentParser(description="Evaluate student prompts via MCP tool")
+    ap.add_argument("-f","--file",required=True, nargs="+", help="Path(s) to text files with student prompts")
     args = ap.parse_args()
 
-    student_text = Path(args.file).read_text(encoding="utf-8")
     import os
     # Build a minimal env for the child:
     child_env = {
@@ -30,25 +48,15 @@ async def main():
         env=child_env,   # <-- only these keys are passed down
     )
 
+    # Read the prompt files off-loop while the server process spawns and handshakes
+    reads = asyncio.gather(*(asyncio.to_thread(Path(p).read_text, encoding="utf-8") for p in args.file))
+
+    # One server process for every file: startup + handshake are paid once
     async with stdio_client(server_params) as (read, write):
         async with ClientSession(read, write) as session:
-            await session.initialize()
-            console.print(Panel.fit("Calling evaluate_prompt(...) via MCP", border_style="cyan"))
-            res = await session.call_tool("evaluate_prompt", arguments={"student_prompt": student_text})
-
-            text = res.content[0].text if res and res.content else "{}"
-            try:
-                data = json.loads(text)
-                out = Path("outputs") / (Path(args.file).stem + ".json")
-                out.parent.mkdir(parents=True, exist_ok=True)
-                out.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-                console.print(Panel.fit(f"Saved JSON → {out}", border_style="green"))
-                console.print_json(data=data)
-            except Exception:
-                out = Path("outputs") / (Path(args.file).stem + ".txt")
-                out.parent.mkdir(parents=True, exist_ok=True)
-                out.write_text(text, encoding="utf-8")
-                console.print(Panel.fit(f"Saved raw text → {out}", border_style="yellow"))
+            _, texts = await asyncio.gather(session.initialize(), reads)
+            for path, student_text in zip(args.file, texts):
+                await evaluate_file(session, path, student_text)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,8 +1,9 @@
 # examples/srs_agent_client.py
-import os, asyncio, json
+import os, asyncio
 from datetime import date
 from pathlib import Path
 
+import orjson
 from dotenv import load_dotenv
 from rich.console import Console
 from rich.panel import Panel
@@ -34,8 +35,13 @@ else:
 # Gemini client
 MODEL = os.getenv("LLM_MODEL", "gemini-2.0-flash")
 API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+TOOL_TIMEOUT = float(os.getenv("MCP_TOOL_TIMEOUT", "30"))
 client = genai.Client(api_key=API_KEY) if API_KEY else None
 
+from gemini_chat import add_turn, gen_config, generate
+from rate_limit import throttle
+
 # Strict system prompt (prevents invented args & enforces pipeline)
 SYSTEM_PROMPT = (
     "You are an SRS Assistant that turns markdown Q/A into a spaced-repetition deck.\n"
@@ -58,6 +64,8 @@ SYSTEM_PROMPT = (
     "3) If a tool returns an error or empty result, retry that tool ONCE with the SAME inputs; if it still fails, emit FINAL_ANSWER: [0].\n"
 )
 
+GEN_CONFIG = gen_config(SYSTEM_PROMPT)
+
 ARG_COUNTS = {
     "parse_markdown": 1,
     "quality_check": 3,
@@ -72,59 +80,83 @@ def validate_call_line(line: str) -> tuple[bool, str]:
     """
     if not line.startswith("FUNCTION_CALL:"):
         return True, ""  # FINAL_ANSWER handled elsewhere
-    try:
-        _, payload = line.split(":", 1)
-        parts = [p.strip() for p in payload.split("|")]
-        fn = parts[0]
-        args = parts[1:]
-    except Exception:
-        return False, "Malformed FUNCTION_CALL; expected 'FUNCTION_CALL: fn|arg1|...'."
-
-    if fn not in ARG_COUNTS:
+    payload = line[len("FUNCTION_CALL:"):]
+    i = payload.find("|")
+    fn = (payload if i < 0 else payload[:i]).strip()
+
+    need = ARG_COUNTS.get(fn)
+    if need is None:
         return False, f"Unknown function '{fn}'. Allowed: {', '.join(ARG_COUNTS)}."
 
-    need = ARG_COUNTS[fn]
-    if len(args) != need:
-        return False, f"{fn} expects {need} arguments; got {len(args)}. Do not add extra labels like 'md|'."
+    n_args = 0 if i < 0 else payload.count("|")
+    if n_args != need:
+        return False, f"{fn} expects {need} arguments; got {n_args}. Do not add extra labels like 'md|'."
     return True, ""
 
-import time
-
-async def generate_with_timeout(prompt: str, timeout: float = 15.0) -> str | None:
+async def generate_with_timeout(contents: list, timeout: float = 15.0) -> str | None:
     """
-    Call Gemini with a short timeout and light retry on 429.
+    Call Gemini with a short timeout and congestion-aware backoff on 429 (see rate_limit.AATB).
     Returns the plaintext model output (single line instruction) or None.
     """
     if not client:
         console.print(Panel("LLM unavailable — set GEMINI_API_KEY or GOOGLE_API_KEY", border_style="red"))
         return None
 
-    def _run_sync():
-        # Synchronous call (what run_in_executor/to_thread expects)
-        return client.models.generate_content(model=MODEL, contents=prompt)
+    for _ in range(LLM_MAX_RETRIES):
+        try:
+            async with throttle.slot():
+                resp = await asyncio.wait_for(
+                    asyncio.to_thread(
+                        client.models.generate_content,
+                        model=MODEL, contents=contents, config=GEN_CONFIG,
+                    ),
+                    timeout=timeout,
+                )
+            throttle.record(denied=False)
+            text = getattr(resp, "text", None)
+            return text.strip() if text else None
+        except Exception as e:
+            msg = str(e)
+            # backoff on rate limit
+            if "429" in msg or "RESOURCE_EXHAUSTED" in msg:
+                throttle.record(denied=True, error=e)  # next slot() waits by congestion / Retry-After
+                continue
+            console.print(Panel(f"LLM Error: {e}", border_style="red"))
+            return None
+    console.print(Panel("LLM Error: rate limited after retries", border_style="red"))
+    return None
+
+
+# Deterministic tools: same arguments → same output, so retries can skip the MCP round-trip.
+# schedule_cards (date-dependent) and export_csv (writes a file) are never cached.
+CACHEABLE_TOOLS = {"parse_markdown", "quality_check"}
+_tool_cache: dict[tuple, str] = {}
+
+async def _call_tool(session: ClientSession, fn: str, arguments: dict) -> str | None:
+    key = (fn, tuple(sorted(arguments.items())))
+    if key in _tool_cache:
+        return _tool_cache[key]
+    res = await session.call_tool(fn, arguments=arguments)
+    out = res.content[0].text if res and res.content else None
+    if out is not None and fn in CACHEABLE_TOOLS:
+        _tool_cache[key] = out
+    return out
+
+async def run_tool(session: ClientSession, fn: str, arguments: dict, default: str = "{}") -> str:
+    """Call an MCP tool (bounded by TOOL_TIMEOUT) and return its text output."""
+    try:
+        out = await asyncio.wait_for(_call_tool(session, fn, arguments), timeout=TOOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        return orjson.dumps({"ok": False, "error": f"tool timed out after {TOOL_TIMEOUT:g}s"}).decode()
+    return out if out is not None else default
 
-    loop = asyncio.get_event_loop()
+_parsed_outputs: dict[str, object] = {}
 
-    try:
-        # first try
-        resp = await asyncio.wait_for(loop.run_in_executor(None, _run_sync), timeout=timeout)
-        text = getattr(resp, "text", None)
-        return text.strip() if text else None
-
-    except Exception as e:
-        msg = str(e)
-        # brief backoff on rate limit
-        if "429" in msg or "RESOURCE_EXHAUSTED" in msg:
-            try:
-                await asyncio.sleep(3)
-                resp = await asyncio.wait_for(loop.run_in_executor(None, _run_sync), timeout=timeout)
-                text = getattr(resp, "text", None)
-                return text.strip() if text else None
-            except Exception as e2:
-                console.print(Panel(f"LLM Error: {e2}", border_style="red"))
-                return None
-        console.print(Panel(f"LLM Error: {e}", border_style="red"))
-        return None
+def parse_tool_json(out: str):
+    """orjson-parse a tool's text output once; cached/retried outputs reuse the parsed object."""
+    if out not in _parsed_outputs:
+        _parsed_outputs[out] = orjson.loads(out)
+    return _parsed_outputs[out]
 
 
 async def main():
@@ -145,8 +177,9 @@ async def main():
         async with ClientSession(read, write) as session:
             await session.initialize()
 
-            # Seed conversation with system prompt + concrete markdown
-            prompt = f"{SYSTEM_PROMPT}\n\nMake a deck from this markdown:\n{EXAMPLE_MD}"
+            # Seed conversation with the concrete markdown (SYSTEM_PROMPT travels in GEN_CONFIG)
+            history = []
+            add_turn(history, "user", f"Make a deck from this markdown:\n{EXAMPLE_MD}")
 
             # We keep the raw JSON outputs to pass VERBATIM to the next tool
             last_cards_json = None
@@ -155,17 +188,18 @@ async def main():
             MAX_RETRIES = 1
 
             for turn in range(1, 40):
-                result = await generate_with_timeout(prompt)
+                result = await generate(history, generate_with_timeout)
                 if not result:
                     console.print(Panel("LLM returned no content; exiting.", border_style="red"))
                     break
 
                 console.print(f"Assistant: {result}")
+                add_turn(history, "model", result)
 
                 # Validate format / arity before calling a tool
                 ok, err = validate_call_line(result)
                 if not ok:
-                    prompt += f"\nUser: ERROR — {err} Fix the call and try again using exact arity and verbatim JSON from the previous tool."
+                    add_turn(history, "user", f"ERROR — {err} Fix the call and try again using exact arity and verbatim JSON from the previous tool.")
                     continue
 
                 if result.startswith("FUNCTION_CALL:"):
@@ -176,7 +210,7 @@ async def main():
 
                     # enforce retry policy on the client side too
                     if retries[fn] > MAX_RETRIES:
-                        prompt += "\nUser: ERROR — too many retries on the same tool. Emit FINAL_ANSWER: [0]."
+                        add_turn(history, "user", "ERROR — too many retries on the same tool. Emit FINAL_ANSWER: [0].")
                         continue
 
                     if fn == "parse_markdown":
@@ -186,86 +220,83 @@ async def main():
                         if md_arg == "<markdown>":
                             md_arg = EXAMPLE_MD
 
-                        res = await session.call_tool("parse_markdown", arguments={"md": md_arg})
-                        out = res.content[0].text if res and res.content else "{}"
+                        out = await run_tool(session, "parse_markdown", {"md": md_arg})
                         # Fail fast if tool indicates no cards
                         try:
-                            obj = json.loads(out)
+                            obj = parse_tool_json(out)
                             if obj.get("ok") is False or (obj.get("cards") == []):
                                 retries["parse_markdown"] += 1
-                                prompt += f"\nUser: parse_markdown returned {out}. Retry once with the SAME markdown (no changes)."
+                                add_turn(history, "user", f"parse_markdown returned {out}. Retry once with the SAME markdown (no changes).")
                                 continue
                         except Exception:
                             pass
                         last_cards_json = out
-                        prompt += f"\nUser: parse_markdown returned {out}"
+                        add_turn(history, "user", f"parse_markdown returned {out}")
 
                     elif fn == "quality_check":
                         # exactly three args: cards_json, 3, 260
                         cards_json_arg = args[0]
-                        res = await session.call_tool("quality_check", arguments={
+                        out = await run_tool(session, "quality_check", {
                             "cards_json": cards_json_arg, "min_len": 3, "max_len": 260
                         })
-                        out = res.content[0].text if res and res.content else "{}"
-                        prompt += f"\nUser: quality_check returned {out}"
+                        add_turn(history, "user", f"quality_check returned {out}")
                         try:
-                            qc = json.loads(out)
+                            qc = parse_tool_json(out)
                             if not qc.get("ok"):
                                 retries["quality_check"] += 1
                                 if retries["quality_check"] <= MAX_RETRIES:
-                                    prompt += "\nUser: QC failed; retry quality_check ONCE with the SAME cards_json."
+                                    add_turn(history, "user", "QC failed; retry quality_check ONCE with the SAME cards_json.")
                                     continue
                                 else:
-                                    prompt += "\nUser: QC failed again. Emit FINAL_ANSWER: [0]."
+                                    add_turn(history, "user", "QC failed again. Emit FINAL_ANSWER: [0].")
                         except Exception:
                             retries["quality_check"] += 1
-                            prompt += "\nUser: QC parse error; retry quality_check ONCE with the SAME cards_json."
+                            add_turn(history, "user", "QC parse error; retry quality_check ONCE with the SAME cards_json.")
                             continue
 
                     elif fn == "schedule_cards":
                         # exactly four args: cards_json, start_date, daily_new, intervals
                         cards_json_arg, start_date_arg, daily_new_arg, intervals_arg = args
-                        res = await session.call_tool("schedule_cards", arguments={
+                        out = await run_tool(session, "schedule_cards", {
                             "cards_json": cards_json_arg,
                             "start_date": start_date_arg or today,
                             "daily_new": int(daily_new_arg),
                             "intervals": intervals_arg or intervals
                         })
-                        out = res.content[0].text if res and res.content else "{}"
-                        prompt += f"\nUser: schedule_cards returned {out}"
+                        add_turn(history, "user", f"schedule_cards returned {out}")
                         try:
-                            sched = json.loads(out)
+                            sched = parse_tool_json(out)
                             scheduled = sched.get("scheduled", [])
                             if not scheduled:
                                 retries["schedule_cards"] += 1
                                 if retries["schedule_cards"] <= MAX_RETRIES:
-                                    prompt += "\nUser: No items scheduled; retry schedule_cards ONCE with the SAME inputs."
+                                    add_turn(history, "user", "No items scheduled; retry schedule_cards ONCE with the SAME inputs.")
                                     continue
                                 else:
-                                    prompt += "\nUser: Scheduling failed again. Emit FINAL_ANSWER: [0]."
+                                    add_turn(history, "user", "Scheduling failed again. Emit FINAL_ANSWER: [0].")
                             else:
                                 last_scheduled_json = out
                         except Exception:
                             retries["schedule_cards"] += 1
-                            prompt += "\nUser: schedule_cards parse error; retry ONCE with the SAME inputs."
+                            add_turn(history, "user", "schedule_cards parse error; retry ONCE with the SAME inputs.")
                             continue
 
                     elif fn == "export_csv":
                         # exactly two args: scheduled_json, filename
                         scheduled_json_arg, filename_arg = args
-                        res = await session.call_tool("export_csv", arguments={
+                        out = await run_tool(session, "export_csv", {
                             "scheduled_json": scheduled_json_arg,
                             "filename": filename_arg
-                        })
-                        out = res.content[0].text if res and res.content else ""
-                        prompt += f"\nUser: export_csv returned {out}"
+                        }, default="")
+                        add_turn(history, "user", f"export_csv returned {out}")
 
                 elif result.startswith("FINAL_ANSWER:"):
                     # done
                     break
 
                 # Keep conversation flowing
-                prompt += f"\nAssistant: {result}"
+                if history[-1]["role"] == "model":
+                    add_turn(history, "user", "Next step?")
 
             console.print(Panel("SRS pipeline completed!", border_style="green"))
 
@@ -1,54 +1,89 @@
 from mcp.server.fastmcp import FastMCP
 from mcp.types import TextContent
-from rich.console import Console
-from rich.panel import Panel
-import sys, re
+import sys, re, ast, operator, functools
+
+from stderr_log import log, rich_console  # IMPORTANT: STDERR only; STDOUT carries MCP JSON-RPC
 
-# IMPORTANT: log to STDERR so MCP JSON-RPC on STDOUT isn't polluted
-console = Console(file=sys.stderr)
 mcp = FastMCP("CoTCalculator")
 
-ALLOWED_EXPR = re.compile(r"^[0-9.\s+\-*/%()]+$")  # only arithmetic tokens
+ALLOWED_EXPR = re.compile(r"[0-9.\s+\-*/%()]+")  # only arithmetic tokens (match with .fullmatch)
+
+# `**` is the one operator that can blow up from a short input (9**9**9**9 would hang the server)
+MAX_EXPONENT = 1000
+MAX_POW_BITS = 1 << 16  # cap on the size of an integer power's result
+
+def _pow(base, exp):
+    if abs(exp) > MAX_EXPONENT:
+        raise ValueError(f"exponent {exp} exceeds {MAX_EXPONENT}")
+    if isinstance(base, int) and isinstance(exp, int) and base.bit_length() * exp > MAX_POW_BITS:
+        raise ValueError(f"result of {base.bit_length()}-bit base ** {exp} is too large")
+    return operator.pow(base, exp)
+
+_BIN_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod, ast.Pow: _pow,
+}
+_UNARY_OPS = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+
+def _eval_node(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+        return _BIN_OPS[type(node.op)](_eval_node(node.left), _eval_node(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+        return _UNARY_OPS[type(node.op)](_eval_node(node.operand))
+    raise ValueError(f"unsupported syntax: {ast.dump(node)}")
+
+@functools.lru_cache(maxsize=256)
+def _safe_eval(expression: str):
+    """Evaluate arithmetic via the AST (no eval); memoized so verify reuses calculate's work."""
+    return _eval_node(ast.parse(expression, mode="eval").body)
 
 @mcp.tool()
 def show_reasoning(steps: list) -> TextContent:
     """Show the step-by-step reasoning process"""
-    console.print(Panel("Showing reasoning steps", border_style="cyan"))
-    for i, step in enumerate(steps, 1):
-        console.print(Panel(f"{step}", title=f"Step {i}", border_style="cyan"))
+    console = rich_console()
+    if console is None:
+        sys.stderr.write("".join(f"Step {i}: {step}\n" for i, step in enumerate(steps, 1)))
+    else:
+        from rich.console import Group
+        from rich.panel import Panel
+        # one render + flush for all steps instead of one per step
+        panels = [Panel(f"{step}", title=f"Step {i}", border_style="cyan") for i, step in enumerate(steps, 1)]
+        console.print(Panel(Group(*panels), title="Showing reasoning steps", border_style="cyan"))
     return TextContent(type="text", text="Reasoning shown")
 
 @mcp.tool()
 def calculate(expression: str) -> TextContent:
     """Calculate the result of an expression"""
     expression = (expression or "").strip()
-    if not ALLOWED_EXPR.match(expression):
+    if not ALLOWED_EXPR.fullmatch(expression):
         return TextContent(type="text", text="Error: disallowed characters in expression")
     try:
-        # sandbox eval: demo-only
-        result = eval(expression, {"__builtins__": {}}, {})
-        console.print(Panel(f"Calculating: {expression} = {result}", border_style="green"))
+        result = _safe_eval(expression)
+        log(f"Calculating: {expression} = {result}", border_style="green")
         return TextContent(type="text", text=str(result))
     except Exception as e:
-        console.print(Panel(f"Error: {e}", border_style="red"))
+        log(f"Error: {e}", border_style="red")
         return TextContent(type="text", text=f"Error: {str(e)}")
 
 @mcp.tool()
 def verify(expression: str, expected: float) -> TextContent:
     """Verify if a calculation is correct"""
     expression = (expression or "").strip()
-    if not ALLOWED_EXPR.match(expression):
+    if not ALLOWED_EXPR.fullmatch(expression):
         return TextContent(type="text", text="Error: disallowed characters in expression")
     try:
-        actual = float(eval(expression, {"__builtins__": {}}, {}))
+        actual = float(_safe_eval(expression))
         ok = abs(actual - float(expected)) < 1e-10
         if ok:
-            console.print(Panel(f"✓ Verified: {expression} = {expected}", border_style="green"))
+            log(f"✓ Verified: {expression} = {expected}", border_style="green")
         else:
-            console.print(Panel(f"✗ Mismatch: {expression} evaluated to {actual}, expected {expected}", border_style="red"))
+            log(f"✗ Mismatch: {expression} evaluated to {actual}, expected {expected}", border_style="red")
         return TextContent(type="text", text=str(ok))
     except Exception as e:
-        console.print(Panel(f"Error: {e}", border_style="red"))
+        log(f"Error: {e}", border_style="red")
         return TextContent(type="text", text=f"Error: {str(e)}")
 
 if __name__ == "__main__":
@@ -1,14 +1,12 @@
 # tools/eval_tools.py
-import os, sys, time, json, re
+import os, sys, time, re, hashlib, random
+from collections import OrderedDict
 from typing import Optional
-
-# IMPORTANT: Rich logs to STDERR to avoid corrupting JSON-RPC on STDOUT
-from rich.console import Console
-from rich.panel import Panel
-console = Console(file=sys.stderr)
+import orjson
 
 from mcp.server.fastmcp import FastMCP
 from mcp.types import TextContent
+from stderr_log import log  # IMPORTANT: STDERR only; STDOUT carries MCP JSON-RPC
 mcp = FastMCP("PromptEval")
 
 from dotenv import load_dotenv
@@ -16,13 +14,31 @@ load_dotenv(override=False)  # keep shell exports authoritative
 
 
 # ---- Gemini client with ENV-driven model and fallbacks ----
-try:
+def _make_client(api_key: str):
+    """One client per process with an explicit keep-alive pool, so evaluations reuse TCP+TLS connections."""
     from google import genai
-    GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-    _gemini_client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
-except Exception as e:
-    console.print(Panel(f"google-genai import error: {e}", border_style="red"))
-    _gemini_client = None
+    try:
+        import httpx
+        from google.genai import types
+        limits = httpx.Limits(max_keepalive_connections=16, max_connections=32, keepalive_expiry=60)
+        return genai.Client(api_key=api_key, http_options=types.HttpOptions(client_args={"limits": limits}))
+    except Exception:
+        # older google-genai without HttpOptions.client_args: its default httpx client still keeps alive
+        return genai.Client(api_key=api_key)
+
+# google-genai (and its gRPC/protobuf/httpx stack) loads on the first gemini_eval, not at startup
+_gemini_client = None  # False once creation failed or no key is set
+
+def _get_client():
+    global _gemini_client
+    if _gemini_client is None:
+        api_key = os.getenv("GEMINI_API_KEY")
+        try:
+            _gemini_client = _make_client(api_key) if api_key else False
+        except Exception as e:
+            log(f"google-genai import error: {e}", "red")
+            _gemini_client = False
+    return _gemini_client or None
 
 PRIMARY_MODEL = (
     os.getenv("LLM_MODEL") or
@@ -30,18 +46,38 @@ PRIMARY_MODEL = (
     "gemini-2.0-flash"  # safe for v1beta generateContent
 )
 
-FALLBACK_MODELS = [
+_JSON_BLOCK_RE = re.compile(r"\{.*\}", re.S)  # outermost {...} in a chatty reply
+
+FALLBACK_MODELS = list(dict.fromkeys([  # de-duplicated, order kept
     PRIMARY_MODEL,
     "gemini-2.0-flash",
     # add "gemini-1.5-flash" here only if your SDK supports it for v1beta generateContent
-]
+]))
+
+# Each model gets a few tries on 429 (backoff 0.5s, 1s, 2s + jitter) before falling back to the next
+ATTEMPTS_PER_MODEL = 3
+_ATTEMPTS = [(model, attempt) for model in FALLBACK_MODELS for attempt in range(ATTEMPTS_PER_MODEL)]
+
+def _backoff(attempt: int) -> float:
+    return min(8, 0.5 * 2 ** attempt) + random.random() * 0.25
+
+# Exact-match cache of successful evaluations: blake2b(student_prompt) -> parsed dict (LRU)
+_EVAL_CACHE: "OrderedDict[bytes, dict]" = OrderedDict()
+_EVAL_CACHE_SIZE = 1024
 
 def gemini_eval(student_prompt: str) -> Optional[dict]:
     """Ask Gemini to score the prompt. Returns dict or None on failure."""
-    if not _gemini_client:
-        console.print(Panel("No GEMINI_API_KEY or client unavailable.", border_style="yellow"))
+    client = _get_client()
+    if not client:
+        log("No GEMINI_API_KEY or client unavailable.", "yellow")
         return None
 
+    key = hashlib.blake2b(student_prompt.encode("utf-8"), digest_size=16).digest()
+    if key in _EVAL_CACHE:
+        _EVAL_CACHE.move_to_end(key)
+        log("evaluate_prompt cache hit", "green", panel=False)
+        return _EVAL_CACHE[key]
+
     system_prompt = (
         "You are a prompt-evaluation assistant. "
         "Given a student's prompt, return ONLY a compact JSON object with boolean flags and a short overall_clarity string. "
@@ -53,45 +89,66 @@ def gemini_eval(student_prompt: str) -> Optional[dict]:
     user_prompt = f"STUDENT_PROMPT:\n{student_prompt}"
 
     last_err = None
-    for model in FALLBACK_MODELS:
+    skip = set()  # models that are unsupported or returned an empty/blocked reply
+    for i, (model, attempt) in enumerate(_ATTEMPTS):
+        if model in skip:
+            continue
         try:
-            resp = _gemini_client.models.generate_content(
+            resp = client.models.generate_content(
                 model=model,
                 contents=f"{system_prompt}\n\n{user_prompt}"
             )
-            text = getattr(resp, "text", None)
+            text = resp.text if resp and resp.candidates else None
             if not text:
+                skip.add(model)  # empty or blocked: retrying the same model won't help
                 continue
-            # extract JSON block (be tolerant)
-            m = re.search(r"\{.*\}", text, re.S)
-            raw = m.group(0) if m else text.strip()
-            return json.loads(raw)
+            data = None
+            if text.lstrip().startswith("{"):  # usual case: bare JSON, no regex scan
+                try:
+                    data = orjson.loads(text)
+                except orjson.JSONDecodeError:
+                    pass
+            if data is None:
+                # extract JSON block (be tolerant of prefaces/trailers)
+                m = _JSON_BLOCK_RE.search(text)
+                data = orjson.loads(m.group(0) if m else text.strip())
+            _EVAL_CACHE[key] = data
+            if len(_EVAL_CACHE) > _EVAL_CACHE_SIZE:
+                _EVAL_CACHE.popitem(last=False)
+            return data
         except Exception as e:
             msg = str(e); last_err = e
             if "NOT_FOUND" in msg or "not supported for generateContent" in msg:
-                console.print(f"[yellow]Model not supported on v1beta: {model}; trying next...[/yellow]")
+                log(f"Model not supported on v1beta: {model}; trying next...", "yellow", panel=False)
+                skip.add(model)
                 continue
             if "RESOURCE_EXHAUSTED" in msg or "429" in msg:
-                console.print("[yellow]429 quota—short backoff 3s…[/yellow]")
-                time.sleep(3)
+                if any(m not in skip for m, _ in _ATTEMPTS[i + 1:]):  # don't sleep just to give up
+                    delay = _backoff(attempt)
+                    log(f"429 quota on {model}—backoff {delay:.1f}s…", "yellow", panel=False)
+                    time.sleep(delay)
                 continue
-            console.print(Panel(f"Gemini error on {model}: {e}", border_style="red"))
+            log(f"Gemini error on {model}: {e}", "red")
             break
-    console.print(Panel(f"Gemini failed across models. Last error: {last_err}", border_style="red"))
+    log(f"Gemini failed across models. Last error: {last_err}", "red")
     return None
 
 # ---- Heuristic fallback: produces deterministic JSON if LLM unavailable ----
+# Keyword groups, checked with `in` (C substring search; faster here than one alternation regex).
+_REASONING_KWS = ("step by step", "follow this order", "pipeline", "sequence")
+_STRUCTURE_KWS = ("function_call:", "final_answer:", "one line", "strict")
+_TOOL_KWS = ("parse_markdown", "quality_check", "schedule_cards", "export_csv")
+_FRAMING_KWS = ("rules:", "output format", "pipeline", "example")
+
 def heuristic_eval(student_prompt: str) -> dict:
     sp = student_prompt.lower()
 
     # simple keyword heuristics to decide booleans
-    explicit_reasoning = any(k in sp for k in [
-        "step by step", "follow this order", "pipeline", "sequence"
-    ])
-    structured_output = "function_call:" in sp or "final_answer:" in sp or "one line" in sp or "strict" in sp
-    tool_separation = "parse_markdown" in sp and "quality_check" in sp and "schedule_cards" in sp and "export_csv" in sp
-    conversation_loop = any(k in sp for k in ["turn", "per turn", "one line per turn", "multi-turn"])
-    instructional_framing = any(k in sp for k in ["rules:", "output format", "pipeline", "example"])
+    explicit_reasoning = any(k in sp for k in _REASONING_KWS)
+    structured_output = any(k in sp for k in _STRUCTURE_KWS)
+    tool_separation = all(k in sp for k in _TOOL_KWS)
+    conversation_loop = "turn" in sp  # covers "per turn", "one line per turn", "multi-turn"
+    instructional_framing = any(k in sp for k in _FRAMING_KWS)
     internal_self_checks = False  # intentionally false per your test target
     reasoning_type_awareness = False  # intentionally false per your test target
     fallbacks = False  # intentionally false per your test target
@@ -119,11 +176,11 @@ def evaluate_prompt(student_prompt: str) -> TextContent:
     Evaluate a student's prompt and return JSON with the expected keys.
     Tries Gemini first (model from env), falls back to a deterministic heuristic if unavailable.
     """
-    console.print(Panel("evaluate_prompt called", border_style="cyan"))
+    log("evaluate_prompt called")
 
     data = gemini_eval(student_prompt)
     if data is None:
-        console.print(Panel("Using heuristic fallback", border_style="yellow"))
+        log("Using heuristic fallback", "yellow")
         data = heuristic_eval(student_prompt)
 
     # Ensure only the required keys appear and types are correct
@@ -139,7 +196,7 @@ def evaluate_prompt(student_prompt: str) -> TextContent:
         "overall_clarity": str(data.get("overall_clarity", "")).strip() or
             "Clear structure; missing explicit self-checks and error fallbacks."
     }
-    return TextContent(type="text", text=json.dumps(clean, ensure_ascii=False))
+    return TextContent(type="text", text=orjson.dumps(clean).decode())
 
 if __name__ == "__main__":
     # stdio server for MCP; no stdout printing except JSON-RPC by framework
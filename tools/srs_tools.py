@@ -2,113 +2,216 @@
 
 from mcp.server.fastmcp import FastMCP
 from mcp.types import TextContent
-from rich.console import Console
-from rich.panel import Panel
-import json, csv, io, sys, re
+from stderr_log import log  # error panels; happy-path diagnostics use `logger` below
+import csv, io, os, sys, re, hashlib, logging
+from collections import OrderedDict
+import orjson
 from datetime import date, timedelta
 
-console = Console(file=sys.stderr)
 mcp = FastMCP("SRS")
 
-_QA_RE = re.compile(r'^\s*Q:\s*(.+?)\s*\nA:\s*(.+?)\s*(?:\n{1,2}|$)', re.M | re.S)
+# Happy-path diagnostics go through a level-gated logger (STDERR; STDOUT is JSON-RPC).
+# Below the configured level each call is one isEnabledFor check. SRS_LOG_LEVEL=DEBUG to see them.
+logger = logging.getLogger("mcp.srs")
+_log_handler = logging.StreamHandler(sys.stderr)
+_log_handler.setFormatter(logging.Formatter("%(name)s %(levelname)s: %(message)s"))
+logger.addHandler(_log_handler)
+logger.propagate = False
+_log_level = os.getenv("SRS_LOG_LEVEL", "INFO").upper()
+try:
+    logger.setLevel(_log_level)
+except ValueError:  # unknown name: don't kill the server before the MCP handshake
+    logger.setLevel(logging.INFO)
+    logger.warning("Unknown SRS_LOG_LEVEL %r; using INFO", _log_level)
+
+def _dumps(obj) -> str:
+    """orjson encode as str for TextContent (UTF-8, non-ASCII kept as-is)."""
+    return orjson.dumps(obj).decode()
+
+# Payloads flow parse → qc → schedule → export as JSON text inside this one process.
+# Remember the parsed form keyed by a content hash so the next tool skips re-parsing (LRU).
+_PARSED_CACHE: "OrderedDict[bytes, dict]" = OrderedDict()
+_PARSED_CACHE_SIZE = 128
+
+def _digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+def _remember(text: str, obj: dict) -> str:
+    _PARSED_CACHE[_digest(text)] = obj
+    if len(_PARSED_CACHE) > _PARSED_CACHE_SIZE:
+        _PARSED_CACHE.popitem(last=False)
+    return text
+
+def _loads(text: str) -> dict:
+    k = _digest(text)
+    obj = _PARSED_CACHE.get(k)
+    if obj is None:
+        obj = orjson.loads(text)
+        if isinstance(obj, dict):
+            _remember(text, obj)
+    else:
+        _PARSED_CACHE.move_to_end(k)
+    return obj
+
+# Q may continue over lines that don't start with Q:/A:; A is the rest of its line,
+# or the next line when "A:" ends its line.
+# No lazy .+? under re.S, so unmatched "Q:" lines fail fast instead of rescanning to EOF (O(n) vs O(n^2)).
+_QA_RE = re.compile(
+    r"^[ \t]*Q:[ \t]*(?P<q>[^\n]*(?:\n(?![ \t]*[QA]:)[^\n]*)*)\n[ \t]*A:[ \t]*(?:\n[ \t]*)?(?P<a>[^\n]*)",
+    re.M,
+)
+
+# Fixed responses, encoded once at import and returned by reference (treat as read-only)
+_QC_OK = TextContent(type="text", text=_dumps({"ok": True, "errors": []}))
+_NO_CARDS = TextContent(type="text", text=_dumps({
+    "ok": False, "error": "No Q/A pairs found. Ensure lines start with 'Q:' and 'A:'.",
+    "cards": []
+}))
 
 @mcp.tool()
 def parse_markdown(md: str) -> TextContent:
     """Parse 'Q: ...\\nA: ...' pairs into JSON: {"cards":[{"q","a"}]}"""
-    cards = []
-    for m in _QA_RE.finditer(md.strip()):
-        q = m.group(1).strip()
-        a = m.group(2).strip()
-        if q and a:
-            cards.append({"q": q, "a": a})
-
-    result = {"cards": cards}
-    console.print(Panel(f"Parsed {len(cards)} cards", border_style="cyan"))
+    # The pattern is line-anchored and tolerates leading blanks, so md needs no strip().
+    cards = [
+        {"q": q, "a": a}
+        for m in _QA_RE.finditer(md)
+        for q, a in [(m["q"].strip(), m["a"].strip())]
+        if q and a
+    ]
 
     # Fail fast on empty
     if len(cards) == 0:
-        return TextContent(type="text", text=json.dumps({
-            "ok": False, "error": "No Q/A pairs found. Ensure lines start with 'Q:' and 'A:'.",
-            "cards": []
-        }, ensure_ascii=False))
-    return TextContent(type="text", text=json.dumps(result, ensure_ascii=False))
+        log("Parsed 0 cards", "red")
+        return _NO_CARDS
+    result = {"cards": cards}
+    logger.debug("Parsed %d cards", len(cards))
+    return TextContent(type="text", text=_remember(_dumps(result), result))
 
 @mcp.tool()
 def quality_check(cards_json: str, min_len: int = 3, max_len: int = 260) -> TextContent:
     """Validate cards; require >=1 valid card."""
     try:
-        data = json.loads(cards_json)
+        data = _loads(cards_json)
         cards = data.get("cards", [])
     except Exception as e:
-        return TextContent(type="text", text=json.dumps({"ok": False, "errors": [f"Invalid JSON: {e}"]}))
+        return TextContent(type="text", text=_dumps({"ok": False, "errors": [f"Invalid JSON: {e}"]}))
 
     errors = []
     if not cards:
         errors.append("No cards to check (empty).")
-    for i, c in enumerate(cards):
-        q, a = (c.get("q",""), c.get("a",""))
-        if not q or not a:
+    # length pre-pass; only violators pay for message formatting.
+    # Missing/null fields count as length 0 here and are reported as "missing" below.
+    qs = [c.get("q","") for c in cards]
+    as_ = [c.get("a","") for c in cards]
+    ql = [len(q) if q else 0 for q in qs]
+    al = [len(a) if a else 0 for a in as_]
+    bad = [i for i in range(len(cards))
+           if not (min_len <= ql[i] <= max_len and min_len <= al[i] <= max_len) or not qs[i] or not as_[i]]
+    for i in bad:
+        if not qs[i] or not as_[i]:
             errors.append(f"Card {i+1}: missing q or a.")
             continue
-        if not (min_len <= len(q) <= max_len):
-            errors.append(f"Card {i+1} q length {len(q)} outside [{min_len},{max_len}].")
-        if not (min_len <= len(a) <= max_len):
-            errors.append(f"Card {i+1} a length {len(a)} outside [{min_len},{max_len}].")
-
-    ok = len(errors) == 0
-    console.print(Panel("QC passed" if ok else f"QC errors: {len(errors)}", border_style="green" if ok else "red"))
-    return TextContent(type="text", text=json.dumps({"ok": ok, "errors": errors}, ensure_ascii=False))
-
-@mcp.tool()
-def schedule_cards(cards_json: str, start_date: str, daily_new: int, intervals: str) -> TextContent:
-    """Create simple spaced schedule; fail if zero cards or QC not done."""
+        if not (min_len <= ql[i] <= max_len):
+            errors.append(f"Card {i+1} q length {ql[i]} outside [{min_len},{max_len}].")
+        if not (min_len <= al[i] <= max_len):
+            errors.append(f"Card {i+1} a length {al[i]} outside [{min_len},{max_len}].")
+
+    if not errors:
+        logger.debug("QC passed")
+        return _QC_OK
+    log(f"QC errors: {len(errors)}", "red")
+    return TextContent(type="text", text=_dumps({"ok": False, "errors": errors}))
+
+def _schedule_plan(cards_json: str, start_date: str, daily_new: int, intervals: str):
+    """Shared input checks for the schedule tools -> ((cards, per_day, ints, day_strs), None) or (None, error)."""
     try:
-        data = json.loads(cards_json)
+        data = _loads(cards_json)
         cards = data.get("cards", [])
     except Exception as e:
-        return TextContent(type="text", text=json.dumps({"error": f"Invalid JSON: {e}", "scheduled": []}))
+        return None, f"Invalid JSON: {e}"
 
     if not cards:
-        return TextContent(type="text", text=json.dumps({"error": "No cards to schedule", "scheduled": []}))
+        return None, "No cards to schedule"
+
+    try:
+        start = date.fromisoformat(start_date)
+    except ValueError:  # non-padded forms like 2025-1-5 (only accepted by fromisoformat on 3.11+)
+        start = date(*map(int, start_date.split("-")))
+    ints = tuple(map(int, intervals.split(",")))
+    if min(ints) < 0:
+        return None, "intervals must be non-negative day offsets"
+
+    # day_strs: ISO date for each day offset actually used (learning days + their reviews), formatted once.
+    # Not a dense range up to the largest interval: that would grow with e.g. intervals="1,3,2500000".
+    per_day = max(1, daily_new)
+    learn_days = range((len(cards) - 1) // per_day + 1)
+    offsets = set(learn_days).union(o + k for o in learn_days for k in ints)
+    day_strs = {k: (start + timedelta(days=k)).isoformat() for k in offsets}
+    return (cards, per_day, ints, day_strs), None
+
+@mcp.tool()
+def schedule_cards(cards_json: str, start_date: str, daily_new: int, intervals: str) -> TextContent:
+    """Create simple spaced schedule; fail if zero cards or QC not done."""
+    plan, err = _schedule_plan(cards_json, start_date, daily_new, intervals)
+    if err:
+        return TextContent(type="text", text=_dumps({"error": err, "scheduled": []}))
+    cards, per_day, ints, day_strs = plan
 
-    y, m, d = [int(x) for x in start_date.split("-")]
-    start = date(y, m, d)
-    ints = [int(x) for x in intervals.split(",")]
+    # review dates depend only on the learning day; build each day's list once
+    reviews = [[day_strs[o + k] for k in ints] for o in range((len(cards) - 1) // per_day + 1)]
 
     scheduled = []
     for i, c in enumerate(cards):
-        day_offset = (i // max(1, daily_new))  # simple batching by daily_new
-        learn_on = start + timedelta(days=day_offset)
-        reviews_on = [str(learn_on + timedelta(days=k)) for k in ints]
+        day_offset = (i // per_day)  # simple batching by daily_new
         scheduled.append({
             "q": c["q"], "a": c["a"],
-            "learn_on": str(learn_on),
-            "reviews_on": reviews_on
+            "learn_on": day_strs[day_offset],
+            "reviews_on": reviews[day_offset]
         })
 
-    console.print(Panel(f"Scheduled {len(scheduled)} cards", border_style="cyan"))
-    return TextContent(type="text", text=json.dumps({"scheduled": scheduled}, ensure_ascii=False))
+    logger.debug("Scheduled %d cards", len(scheduled))
+    result = {"scheduled": scheduled}
+    return TextContent(type="text", text=_remember(_dumps(result), result))
 
 @mcp.tool()
 def export_csv(scheduled_json: str, filename: str) -> TextContent:
     """Write a CSV with columns: q,a,learn_on,reviews_on"""
     try:
-        data = json.loads(scheduled_json)
+        data = _loads(scheduled_json)
         scheduled = data.get("scheduled", [])
     except Exception as e:
-        return TextContent(type="text", text=json.dumps({"error": f"Invalid JSON: {e}"}))
+        return TextContent(type="text", text=_dumps({"error": f"Invalid JSON: {e}"}))
 
     if not scheduled:
-        return TextContent(type="text", text=json.dumps({"error": "No scheduled items to write"}))
+        return TextContent(type="text", text=_dumps({"error": "No scheduled items to write"}))
+
+    path = filename
+    with open(path, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
+        w = csv.writer(f)
+        w.writerow(["q","a","learn_on","reviews_on"])
+        w.writerows((s["q"], s["a"], s["learn_on"], "|".join(s["reviews_on"])) for s in scheduled)
+
+    logger.debug("Wrote %d rows → %s", len(scheduled), path)
+    return TextContent(type="text", text=path)
+
+@mcp.tool()
+def schedule_and_export_csv(cards_json: str, start_date: str, daily_new: int, intervals: str, filename: str) -> TextContent:
+    """schedule_cards + export_csv in one step: rows are written as they are scheduled, no scheduled JSON in between."""
+    plan, err = _schedule_plan(cards_json, start_date, daily_new, intervals)
+    if err:
+        return TextContent(type="text", text=_dumps({"error": err}))
+    cards, per_day, ints, day_strs = plan
+
+    # cards learned on the same day share their review dates: join them once per day
+    reviews = ["|".join(day_strs[o + k] for k in ints) for o in range((len(cards) - 1) // per_day + 1)]
 
     path = filename
-    with open(path, "w", newline="", encoding="utf-8") as f:
+    with open(path, "w", newline="", encoding="utf-8", buffering=1 << 20) as f:
         w = csv.writer(f)
         w.writerow(["q","a","learn_on","reviews_on"])
-        for s in scheduled:
-            w.writerow([s["q"], s["a"], s["learn_on"], "|".join(s["reviews_on"])])
+        w.writerows((c["q"], c["a"], day_strs[i // per_day], reviews[i // per_day]) for i, c in enumerate(cards))
 
-    console.print(Panel(f"Wrote {len(scheduled)} rows → {path}", border_style="green"))
+    logger.debug("Scheduled and wrote %d rows → %s", len(cards), path)
     return TextContent(type="text", text=path)
 
 if __name__ == "__main__":
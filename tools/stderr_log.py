@@ -0,0 +1,34 @@
+# tools/stderr_log.py
+"""
+STDERR logging shared by the MCP tool servers (STDOUT carries JSON-RPC).
+
+Rich is imported on the first log, and only when STDERR is a TTY and Rich is
+installed; otherwise every message is written as one plain line.
+"""
+import sys
+
+_console = None
+
+def rich_console():
+    """The shared Rich console, or None when logging plain lines."""
+    global _console
+    if _console is None:
+        _console = False
+        if sys.stderr.isatty():
+            try:
+                from rich.console import Console
+                _console = Console(file=sys.stderr)
+            except ImportError:
+                pass
+    return _console or None
+
+def log(msg: str, border_style: str = "cyan", panel: bool = True) -> None:
+    """A bordered panel, or with panel=False one line styled `border_style`."""
+    console = rich_console()
+    if console is None:
+        sys.stderr.write(f"{msg}\n")
+    elif panel:
+        from rich.panel import Panel
+        console.print(Panel(msg, border_style=border_style))
+    else:
+        console.print(msg, style=border_style)